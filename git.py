@@ -6,29 +6,115 @@ command line tool directly, so please be careful with using untrusted
 parameters.
 """
 
+import atexit
+import concurrent.futures
 import functools
-import sys
+import os
+import re
+import threading
 import io
 import subprocess
-from collections import defaultdict
 import email.utils
 import datetime
-import urllib.request, urllib.parse, urllib.error
-from html import escape
-from typing import Any, Dict, IO, Iterable, List, Optional, Tuple, Union
+import urllib.parse
+from types import SimpleNamespace
+from typing import (
+    Any,
+    Dict,
+    IO,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Union,
+    overload,
+)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore
 
 
 # Path to the git binary.
 GIT_BIN = "git"
 
+# Size we ask the kernel for the pipes we read git's output from, and size of
+# the userspace buffer for reading them. The default pipe size (64 KiB on
+# Linux) means a lot of small reads and context switches for big outputs.
+PIPE_SIZE = 1 << 20
+READ_BUFFER_SIZE = 1 << 16
+
+
+def _grow_pipe(fd: int):
+    """Makes the given pipe bigger, see PIPE_SIZE. This is just a hint, so we
+    ignore any errors, and it does nothing where it's not supported."""
+    if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except OSError:
+        pass
+
+
+def _decode_text(b: bytes) -> str:
+    """Decodes git output to text, the same way run_git() does: decoding
+    errors are backslash-escaped, and newlines are translated."""
+    s = b.decode("utf8", "backslashreplace")
+    if "\r" in s:
+        s = s.replace("\r\n", "\n").replace("\r", "\n")
+    return s
+
+
+def _output_file(out: bytes, raw: bool) -> Union[io.BytesIO, io.StringIO]:
+    """Wraps the full output of a git command in a file-like object."""
+    if raw:
+        return io.BytesIO(out)
 
+    # newline=None translates newlines just like the TextIOWrapper does.
+    return io.StringIO(out.decode("utf8", "backslashreplace"), newline=None)
+
+
+# The type of the output depends on raw, so callers get a precise one.
+@overload
 def run_git(
-    repo_path: str, params, stdin: bytes = None, silent_stderr=False, raw=False
+    repo_path: str,
+    params,
+    stdin: Optional[bytes] = None,
+    silent_stderr: bool = False,
+    *,
+    raw: Literal[True],
+    read_all: bool = False,
+) -> IO[bytes]: ...
+
+
+@overload
+def run_git(
+    repo_path: str,
+    params,
+    stdin: Optional[bytes] = None,
+    silent_stderr: bool = False,
+    raw: Literal[False] = False,
+    read_all: bool = False,
+) -> IO[str]: ...
+
+
+def run_git(
+    repo_path: str,
+    params,
+    stdin: Optional[bytes] = None,
+    silent_stderr: bool = False,
+    raw: bool = False,
+    read_all: bool = False,
 ) -> Union[IO[str], IO[bytes]]:
     """Invokes git with the given parameters.
 
     This function invokes git with the given parameters, and returns a
     file-like object with the output (from a pipe).
+
+    If read_all is True, the command is run to completion and its full output
+    is returned in a memory buffer instead. This is intended for commands
+    with small, bounded outputs.
     """
     params = [GIT_BIN, "--git-dir=%s" % repo_path] + list(params)
 
@@ -36,19 +122,39 @@ def run_git(
     if silent_stderr:
         stderr = subprocess.PIPE
 
+    if read_all:
+        # communicate() reads stdout and stderr concurrently, so a chatty
+        # stderr can't fill up its pipe and block git.
+        p = subprocess.Popen(
+            params,
+            stdin=subprocess.PIPE if stdin else None,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        )
+        out, _ = p.communicate(stdin)
+        return _output_file(out, raw)
+
     if not stdin:
         p = subprocess.Popen(
-            params, stdin=None, stdout=subprocess.PIPE, stderr=stderr
+            params,
+            stdin=None,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            bufsize=READ_BUFFER_SIZE,
         )
+        assert p.stdout is not None
+        _grow_pipe(p.stdout.fileno())
     else:
         p = subprocess.Popen(
             params,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=stderr,
+            bufsize=READ_BUFFER_SIZE,
         )
 
-        assert p.stdin is not None
+        assert p.stdin is not None and p.stdout is not None
+        _grow_pipe(p.stdout.fileno())
         p.stdin.write(stdin)
         p.stdin.close()
 
@@ -62,76 +168,58 @@ def run_git(
     )
 
 
-class GitCommand(object):
-    """Convenient way of invoking git."""
-
-    def __init__(self, path: str, cmd: str):
-        self._override = True
-        self._path = path
-        self._cmd = cmd
-        self._args: List[str] = []
-        self._kwargs: Dict[str, str] = {}
-        self._stdin_buf: Optional[bytes] = None
-        self._raw = False
-        self._override = False
-
-    def __setattr__(self, k, v):
-        if k == "_override" or self._override:
-            self.__dict__[k] = v
-            return
-        k = k.replace("_", "-")
-        self._kwargs[k] = v
-
-    def arg(self, a: str):
-        """Adds an argument."""
-        self._args.append(a)
-
-    def raw(self, b: bool):
-        """Request raw rather than utf8-encoded command output."""
-        self._override = True
-        self._raw = b
-        self._override = False
-
-    def stdin(self, s: bytes):
-        """Sets the contents we will send in stdin."""
-        self._override = True
-        self._stdin_buf = s
-        self._override = False
-
-    def run(self):
-        """Runs the git command."""
-        params = [self._cmd]
+# Translation table for smstr's HTML representation, so it's done in a single
+# pass: it does the same escaping as html.escape(), and control characters
+# are shown escaped, inside a span so they can be styled.
+_HTML_TABLE = {
+    ord(c): '<span class="ctrlchr">%s</span>'
+    % c.encode("unicode-escape").decode("utf8")
+    for c in "\t\r\n\f\a\b\v\0"
+}
+_HTML_TABLE.update(
+    {
+        ord("&"): "&amp;",
+        ord("<"): "&lt;",
+        ord(">"): "&gt;",
+        ord('"'): "&quot;",
+        ord("'"): "&#x27;",
+    }
+)
 
-        for k, v in list(self._kwargs.items()):
-            dash = "--" if len(k) > 1 else "-"
-            if v is None:
-                params.append("%s%s" % (dash, k))
-            else:
-                params.append("%s%s=%s" % (dash, k, str(v)))
 
-        params.extend(self._args)
+# The same names show up over and over again (in trees, diffs, across
+# branches), so we cache their representations at the module level.
+@functools.lru_cache(maxsize=8192)
+def _raw_to_url(s: str) -> str:
+    """Returns the URL-embeddable representation of the string."""
+    return urllib.parse.quote(s, safe="/")
 
-        return run_git(self._path, params, self._stdin_buf, raw=self._raw)
 
-
-class SimpleNamespace(object):
-    """An entirely flexible object, which provides a convenient namespace."""
-
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+@functools.lru_cache(maxsize=8192)
+def _raw_to_html(s: str) -> str:
+    """Returns the HTML-embeddable representation of the string."""
+    return s.translate(_HTML_TABLE)
 
 
 class smstr:
     """A "smart" string, containing many representations for ease of use."""
 
+    __slots__ = ("raw",)
+
     raw: str  # string, probably utf8-encoded, good enough to show.
-    url: str  # escaped for safe embedding in URLs (not human-readable).
-    html: str  # HTML-embeddable representation.
 
     def __init__(self, s: str):
         self.raw = s
-        self.url = urllib.request.pathname2url(s)
-        self.html = self._to_html()
+
+    @property
+    def url(self) -> str:
+        """Escaped for safe embedding in URLs (not human-readable)."""
+        return _raw_to_url(self.raw)
+
+    @property
+    def html(self) -> str:
+        """HTML-embeddable representation."""
+        return _raw_to_html(self.raw)
 
     # Note we don't define __repr__() or __str__() to prevent accidental
     # misuse. It does mean that some uses become more annoying, so it's a
@@ -140,7 +228,7 @@ class smstr:
     @staticmethod
     def from_url(url):
         """Returns an smstr() instance from an url-encoded string."""
-        return smstr(urllib.request.url2pathname(url))
+        return smstr(urllib.parse.unquote(url))
 
     def split(self, sep):
         """Like str.split()."""
@@ -151,19 +239,32 @@ class smstr:
             other = other.raw
         return smstr(self.raw + other)
 
-    def _to_html(self):
-        """Returns an html representation of the unicode string."""
-        html = ""
-        for c in escape(self.raw):
-            if c in "\t\r\n\r\f\a\b\v\0":
-                esc_c = c.encode("unicode-escape").decode("utf8")
-                html += '<span class="ctrlchr">%s</span>' % esc_c
-            else:
-                html += c
 
-        return html
+# Escape sequences used by git when quoting file names: octal for bytes, plus
+# the usual C-style single character ones.
+_UNQUOTE_RE = re.compile(rb"\\([0-7]{3}|.)", re.S)
+_UNQUOTE_CHARS = {
+    b"a": b"\a",
+    b"b": b"\b",
+    b"t": b"\t",
+    b"n": b"\n",
+    b"v": b"\v",
+    b"f": b"\f",
+    b"r": b"\r",
+    b'"': b'"',
+    b"\\": b"\\",
+}
+
+
+def _unescape(m: re.Match) -> bytes:
+    """Returns the byte(s) for a backslash escape matched by _UNQUOTE_RE."""
+    e = m.group(1)
+    if len(e) == 3:
+        return bytes([int(e, 8)])
+    return _UNQUOTE_CHARS.get(e, b"\\" + e)
 
 
+@functools.lru_cache(maxsize=8192)
 def unquote(s: str):
     """Git can return quoted file names, unquote them. Always return a str."""
     if not (s[0] == '"' and s[-1] == '"'):
@@ -176,54 +277,365 @@ def unquote(s: str):
 
     # Get rid of the quotes, we never want them in the output.
     s = s[1:-1]
+    if "\\" not in s:
+        return s
 
-    # Un-escape the backslashes.
-    # latin1 is ok to use here because in Python it just maps the code points
-    # 0-255 to the bytes 0x-0xff, which is what we expect.
-    s = s.encode("latin1").decode("unicode-escape")
+    # Un-escape the backslashes, which gives us the raw bytes of the name,
+    # and convert them to utf8.
+    b = _UNQUOTE_RE.sub(_unescape, s.encode("utf8"))
+    return b.decode("utf8", errors="backslashreplace")
 
-    # Convert to utf8.
-    s = s.encode("latin1").decode("utf8", errors="backslashreplace")
 
-    return s
+@functools.lru_cache(maxsize=8192)
+def _path_smstr(s: str) -> smstr:
+    """Returns smstr(unquote(s)), shared between calls.
+
+    The same file names show up over and over again in diffs, so this saves
+    both the unquoting and the allocation. The instances are shared, so they
+    must not be modified.
+    """
+    return smstr(unquote(s))
+
+
+# Format for the for-each-ref behind Repo._all_refs_cached().
+_REFS_INDEX_FMT = "%00".join(
+    [
+        "%(objecttype)",
+        "%(objectname)",
+        "%(refname)",
+        "%(committerdate:unix)",
+        "%(authordate:unix)",
+        "%(taggerdate:unix)",
+    ]
+)
+
+
+def _parse_refs_index(out: str) -> tuple:
+    """Parses the output of for-each-ref with _REFS_INDEX_FMT."""
+    refs = []
+    for l in out.splitlines():
+        obj_type, obj_id, ref, cdate, adate, tdate = l.split("\0")
+        refs.append(
+            (
+                obj_type,
+                obj_id,
+                ref,
+                int(cdate or 0),
+                int(adate or 0),
+                int(tdate or 0),
+            )
+        )
+    return tuple(refs)
+
+
+def _parse_show_ref(out: str) -> Dict[str, tuple]:
+    """Parses the output of show-ref, returns a dict obj_id -> (ref, ...)."""
+    r: Dict[str, tuple] = {}
+    for l in out.splitlines():
+        obj_id, ref = l.split(" ", 1)
+        # Most objects have a single ref, so tuples are cheap and also safe
+        # to share, since this is cached.
+        r[obj_id] = r.get(obj_id, ()) + (ref,)
+    return r
+
+
+def _pool_size() -> int:
+    """Returns the size for Repo's thread pool, from $GIT_ARR_JOBS.
+
+    Invalid values are ignored, as this runs on import, where there's no good
+    way of reporting them.
+    """
+    try:
+        return max(1, int(os.environ.get("GIT_ARR_JOBS", "8")))
+    except ValueError:
+        return 8
+
+
+def _memoized(method):
+    """Caches the results of a Repo method on the instance, keyed by the
+    method name and arguments, until Repo.invalidate() is called.
+
+    This is for the cheap, ref-related queries, which are called repeatedly
+    while rendering and may change over time; results must not be mutated.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__,) + args
+        if kwargs:
+            key += tuple(sorted(kwargs.items()))
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        r = self._memo[key] = method(self, *args, **kwargs)
+        return r
+
+    return wrapper
 
 
 class Repo:
-    """A git repository."""
+    """A git repository.
+
+    Most methods cache their results, as repositories are long-lived. Caches
+    are explicitly bounded, since the objects can get big (e.g. diffs and
+    blobs), and they're shared across all repositories.
+    """
+
+    # Thread pool used by prefetch(). Most of the work is done by git, so the
+    # threads spend their time waiting on pipes and this scales fine; the
+    # size can be adjusted via the GIT_ARR_JOBS environment variable.
+    _pool = concurrent.futures.ThreadPoolExecutor(max_workers=_pool_size())
+
+    __slots__ = (
+        "path",
+        "name",
+        "info",
+        "_catfile_local",
+        "_catfile_procs",
+        "_catfile_lock",
+        "_memo",
+        "_refs_stamp",
+    )
 
     def __init__(self, path: str, name=None, info=None):
         self.path = path
         self.name = name
         self.info: Any = info or SimpleNamespace()
 
-    def cmd(self, cmd):
-        """Returns a GitCommand() on our path."""
-        return GitCommand(self.path, cmd)
-
-    @functools.lru_cache
-    def _for_each_ref(self, pattern=None, sort=None, count=None):
-        """Returns a list of references."""
-        cmd = self.cmd("for-each-ref")
-        if sort:
-            cmd.sort = sort
-        if count:
-            cmd.count = count
-        if pattern:
-            cmd.arg(pattern)
-
-        refs = []
-        for l in cmd.run():
-            obj_id, obj_type, ref = l.split()
-            refs.append((obj_id, obj_type, ref))
-        return refs
-
-    @functools.cache
-    def branch_names(self):
-        """Get the names of the branches."""
-        refs = self._for_each_ref(pattern="refs/heads/", sort="-authordate")
-        return [ref[len("refs/heads/") :] for _, _, ref in refs]
+        # Long-lived "git cat-file --batch" processes, one per thread, see
+        # cat(). We keep track of all of them so close() can reach them.
+        self._catfile_local = threading.local()
+        self._catfile_procs: List[subprocess.Popen] = []
+        self._catfile_lock = threading.Lock()
+
+        # Results of the @_memoized methods, see invalidate().
+        self._memo: Dict[tuple, Any] = {}
+        self._refs_stamp = self._get_refs_stamp()
+
+    @classmethod
+    def prefetch(cls, *callables):
+        """Runs the given callables in parallel, and waits for them to finish.
+
+        This is meant to be used with the (cached) methods of Repo and Tree,
+        so the git commands behind them run concurrently, and their results
+        are already available by the time they're needed.
+        Note the callables must be invoked exactly as they will be later on,
+        otherwise the cache will miss.
+        """
+        futures = [cls._pool.submit(f) for f in callables]
+        for f in futures:
+            f.result()
+
+    def cat(self, obj_name: Union[str, bytes]) -> Optional[bytes]:
+        """Returns the contents of the given object, or None if missing.
+
+        The object name can be anything git cat-file understands, e.g. an
+        object id or "<ref>:<path>" (as bytes, since paths may not be utf8).
+
+        Objects are read through a long-lived "git cat-file --batch" process,
+        which is spawned on first use, to avoid paying for a new git
+        invocation on every lookup. Each thread gets its own, so concurrent
+        lookups (e.g. from prefetch()) don't have to wait on each other.
+        """
+        if isinstance(obj_name, str):
+            obj_name = obj_name.encode("utf8")
+
+        # Names are newline-delimited in the batch protocol, so we can't ask
+        # for these.
+        if b"\n" in obj_name:
+            return None
+
+        try:
+            return self._cat_once(obj_name)
+        except (OSError, EOFError, ValueError):
+            # The process died, or got out of sync with us (e.g. because a
+            # previous read was interrupted); _cat_once() replaced it, so
+            # try again, once.
+            return self._cat_once(obj_name)
+
+    def _cat_once(self, obj_name: bytes) -> Optional[bytes]:
+        """Asks this thread's "git cat-file --batch" process for an object,
+        see cat(). If anything goes wrong, the process is dropped."""
+        p = self._catfile()
+        try:
+            return self._cat_request(p, obj_name)
+        except (OSError, EOFError, ValueError):
+            self._drop_catfile(p)
+            raise
+
+    @staticmethod
+    def _cat_request(p: subprocess.Popen, obj_name: bytes) -> Optional[bytes]:
+        """Sends a request to a cat-file process, and reads its reply."""
+        assert p.stdin is not None and p.stdout is not None
+        p.stdin.write(obj_name + b"\n")
+        p.stdin.flush()
+
+        # Format: "<size>\n<contents>\n", or
+        # "<obj_name> missing\n" (or "ambiguous") if it can't be found.
+        head = p.stdout.readline()
+        if not head.endswith(b"\n"):
+            raise EOFError("git cat-file exited unexpectedly")
+        if head.endswith((b" missing\n", b" ambiguous\n")):
+            return None
 
-    @functools.cache
+        size = int(head)
+        content = p.stdout.read(size)
+        if len(content) != size or p.stdout.read(1) != b"\n":
+            raise EOFError("short read from git cat-file")
+        return content
+
+    def _catfile(self) -> subprocess.Popen:
+        """Returns this thread's "git cat-file --batch" process, spawning it
+        if necessary."""
+        p = getattr(self._catfile_local, "proc", None)
+        if p is not None and p.poll() is None:
+            return p
+        if p is not None:
+            self._drop_catfile(p)
+
+        p = subprocess.Popen(
+            [
+                GIT_BIN,
+                "--git-dir=%s" % self.path,
+                "cat-file",
+                # We only need the size to know how much to read.
+                "--batch=%(objectsize)",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self._catfile_local.proc = p
+
+        with self._catfile_lock:
+            if not self._catfile_procs:
+                atexit.register(self.close)
+            self._catfile_procs.append(p)
+
+        return p
+
+    def _drop_catfile(self, p: subprocess.Popen):
+        """Stops using the given cat-file process, and terminates it."""
+        if getattr(self._catfile_local, "proc", None) is p:
+            self._catfile_local.proc = None
+        with self._catfile_lock:
+            if p in self._catfile_procs:
+                self._catfile_procs.remove(p)
+        self._end_catfile(p)
+
+    @staticmethod
+    def _end_catfile(p: subprocess.Popen):
+        """Terminates a cat-file process. It may be dead already, or in the
+        middle of a reply, so we close both pipes and ignore errors."""
+        for f in (p.stdin, p.stdout):
+            try:
+                if f is not None:
+                    f.close()
+            except OSError:
+                pass
+        p.wait()
+
+    def close(self):
+        """Terminates the long-lived git processes, if any."""
+        with self._catfile_lock:
+            procs = self._catfile_procs
+            self._catfile_procs = []
+
+        for p in procs:
+            self._end_catfile(p)
+
+    @_memoized
+    def _for_each_ref_format(self, patterns, fmt):
+        """Runs git for-each-ref with the given format, and returns its
+        output as a single string.
+
+        Patterns must be given as a tuple. Results are kept until
+        invalidate() is called, like the rest of the ref information.
+        """
+        params = ["for-each-ref", "--format=" + fmt] + list(patterns)
+
+        return run_git(self.path, params, read_all=True).read()
+
+    def invalidate(self):
+        """Forgets the ref information, so it's loaded again on next use.
+
+        Call this when the repository's branches or tags may have changed.
+        """
+        self._memo = {}
+
+        # These caches are keyed by ref names, so their results may be
+        # stale too. They are shared by all instances, but refs changing is
+        # rare enough that clearing them all is fine.
+        for method in (
+            Repo.commit_ids,
+            Repo.commit,
+            Repo.commits,
+            Repo.diff,
+            Repo.tree,
+            Repo.blob,
+        ):
+            method.cache_clear()
+
+    def _get_refs_stamp(self):
+        """Returns the modification times of the files that change when the
+        refs do, see invalidate_if_changed()."""
+        stamp = []
+        for p in ("HEAD", "packed-refs", "reftable/tables.list"):
+            try:
+                stamp.append(os.stat(self.path + "/" + p).st_mtime_ns)
+            except OSError:
+                stamp.append(None)
+
+        # Loose refs are updated by renaming a lock file into place, which
+        # changes the mtime of the directory they're in; refs can be nested
+        # (e.g. refs/heads/feature/x), so we need to check every directory.
+        for p in ("refs/heads", "refs/tags"):
+            for dirpath, _, _ in os.walk(self.path + "/" + p):
+                try:
+                    stamp.append((dirpath, os.stat(dirpath).st_mtime_ns))
+                except OSError:
+                    pass
+        return tuple(stamp)
+
+    def invalidate_if_changed(self):
+        """Calls invalidate() if the refs look like they have changed.
+
+        This is a cheap heuristic based on modification times, meant to be
+        called on every request by long-lived servers.
+        Note the long-lived cat-file processes are kept, as they resolve
+        names on every lookup anyway.
+        """
+        stamp = self._get_refs_stamp()
+        if stamp != self._refs_stamp:
+            self._refs_stamp = stamp
+            self.invalidate()
+
+    @_memoized
+    def _all_refs_cached(self):
+        """Returns a list of (obj_type, obj_id, ref, committer_epoch,
+        author_epoch, tagger_epoch) for all the branches and tags.
+
+        This is done with a single git invocation, and kept until
+        invalidate() is called; the callers derive their results from it.
+        Epochs are 0 if not applicable to the object.
+        """
+        out = self._for_each_ref_format(
+            ("refs/heads/", "refs/tags/"), _REFS_INDEX_FMT
+        )
+        return _parse_refs_index(out)
+
+    @_memoized
+    def branch_names(self):
+        """Get the names of the branches, most recently authored first."""
+        refs = [
+            (-adate, ref)
+            for _, _, ref, _, adate, _ in self._all_refs_cached()
+            if ref.startswith("refs/heads/")
+        ]
+        refs.sort()
+        return tuple(ref[len("refs/heads/") :] for _, ref in refs)
+
+    @_memoized
     def main_branch(self):
         """Get the name of the main branch."""
         bs = self.branch_names()
@@ -234,25 +646,31 @@ class Repo:
             return bs[0]
         return None
 
-    @functools.cache
-    def tags(self, sort="-taggerdate"):
-        """Get the (name, obj_id) of the tags."""
-        refs = self._for_each_ref(pattern="refs/tags/", sort=sort)
-        return [(ref[len("refs/tags/") :], obj_id) for obj_id, _, ref in refs]
+    @_memoized
+    def tags(self):
+        """Get the (name, obj_id) of the tags, most recently tagged first."""
+        refs = [
+            (-tdate, ref, obj_id)
+            for _, obj_id, ref, _, _, tdate in self._all_refs_cached()
+            if ref.startswith("refs/tags/")
+        ]
+        refs.sort()
+        return tuple(
+            (ref[len("refs/tags/") :], obj_id) for _, ref, obj_id in refs
+        )
 
-    @functools.lru_cache
+    @functools.lru_cache(maxsize=16)
     def commit_ids(self, ref, limit=None):
         """Generate commit ids."""
-        cmd = self.cmd("rev-list")
+        params = ["rev-list"]
         if limit:
-            cmd.max_count = limit
-
-        cmd.arg(ref)
-        cmd.arg("--")
+            params.append("--max-count=%d" % limit)
+        params += [ref, "--"]
 
-        return [l.rstrip("\n") for l in cmd.run()]
+        data = run_git(self.path, params, raw=True, read_all=True).read()
+        return data.decode("utf8", "backslashreplace").split()
 
-    @functools.lru_cache
+    @functools.lru_cache(maxsize=256)
     def commit(self, commit_id):
         """Return a single commit."""
         cs = list(self.commits(commit_id, limit=1))
@@ -260,119 +678,228 @@ class Repo:
             return None
         return cs[0]
 
-    @functools.lru_cache
+    @functools.lru_cache(maxsize=64)
     def commits(self, ref, limit, offset=0):
         """Generate commit objects for the ref."""
-        cmd = self.cmd("rev-list")
-        cmd.max_count = limit + offset
-
-        cmd.header = None
-
-        cmd.arg(ref)
-        cmd.arg("--")
-
-        info_buffer = ""
-        count = 0
+        params = ["rev-list", "--max-count=%d" % limit, "--header"]
+        if offset:
+            params.append("--skip=%d" % offset)
+        params += [ref, "--"]
+
+        # Each commit is terminated by a \0. Read the output in big chunks as
+        # git produces it, and parse the complete records from each one, so
+        # we work on them while git is still walking the history. The last
+        # (incomplete) record is carried over to the next chunk.
+        out = run_git(self.path, params, raw=True)
         commits = []
-        for l in cmd.run():
-            if "\0" in l:
-                pre, post = l.split("\0", 1)
-                info_buffer += pre
-
-                count += 1
-                if count > offset:
-                    commits.append(Commit.from_str(self, info_buffer))
-
-                # Start over.
-                info_buffer = post
-            else:
-                info_buffer += l
-
-        if info_buffer:
-            count += 1
-            if count > offset:
-                commits.append(Commit.from_str(self, info_buffer))
+        carry = b""
+        while True:
+            chunk = out.read1(READ_BUFFER_SIZE)
+            if not chunk:
+                out.close()
+            records = (carry + chunk).split(b"\0")
+            carry = records.pop() if chunk else b""
+
+            for record in records:
+                if not record:
+                    continue
+                buf = record.decode("utf8", "backslashreplace")
+                commits.append(Commit.from_str(self, buf))
+
+            if not chunk:
+                break
 
         return commits
 
-    @functools.lru_cache
+    @functools.lru_cache(maxsize=64)
     def diff(self, ref):
         """Return a Diff object for the ref."""
-        cmd = self.cmd("diff-tree")
-        cmd.patch = None
-        cmd.numstat = None
-        cmd.find_renames = None
+        params = ["diff-tree", "--patch", "--numstat", "--find-renames"]
         if self.info.root_diff:
-            cmd.root = None
+            params.append("--root")
         # Note we intentionally do not use -z, as the filename is just for
         # reference, and it is safer to let git do the escaping.
 
-        cmd.arg(ref)
+        params.append(ref)
 
-        return Diff.from_str(cmd.run())
+        # Read it as bytes, so the body is only decoded if it gets used.
+        out = run_git(self.path, params, raw=True, read_all=True).read()
+        ref_id, _, rest = out.partition(b"\n")
+        if not ref_id:
+            # No diff; this can happen in merges without conflicts.
+            return Diff(None, [], "")
+
+        return Diff.from_parts(ref_id.decode("utf8") + "\n", rest)
 
-    @functools.lru_cache
+    @_memoized
     def refs(self):
-        """Return a dict of obj_id -> ref."""
-        cmd = self.cmd("show-ref")
-        cmd.dereference = None
+        """Return a dict of obj_id -> (ref, ...)."""
+        out = run_git(self.path, ["show-ref", "--dereference"], read_all=True)
+        return _parse_show_ref(out.read())
 
-        r = defaultdict(list)
-        for l in cmd.run():
-            l = l.strip()
-            obj_id, ref = l.split(" ", 1)
-            r[obj_id].append(ref)
+    def load_refs(self):
+        """Loads all the ref information at once, if it's not already.
 
-        return r
+        This runs the git commands behind branch_names(), tags() and refs()
+        concurrently; it's useful before rendering pages that need them all.
+        """
+        if ("_all_refs_cached",) in self._memo and ("refs",) in self._memo:
+            return
+
+        index_out, show_ref_out = self.run_many(
+            [
+                [
+                    "for-each-ref",
+                    "--format=" + _REFS_INDEX_FMT,
+                    "refs/heads/",
+                    "refs/tags/",
+                ],
+                ["show-ref", "--dereference"],
+            ]
+        )
+        self._memo[("_all_refs_cached",)] = _parse_refs_index(index_out)
+        self._memo[("refs",)] = _parse_show_ref(show_ref_out)
+
+    def run_many(self, cmds) -> List[str]:
+        """Runs the given git commands concurrently, returns their outputs.
+
+        They're all started at once, and then their outputs are read in
+        order. While we read one, the others keep running, until they fill
+        up their pipes.
 
-    @functools.lru_cache
+        This doesn't use the prefetch() pool, as it's called from within
+        prefetch() tasks, and waiting on the same pool from them could
+        deadlock when it's small.
+        """
+        outs = [run_git(self.path, params, raw=True) for params in cmds]
+        results = []
+        for out in outs:
+            with out:
+                results.append(out.read().decode("utf8", "backslashreplace"))
+        return results
+
+    @functools.lru_cache(maxsize=16)
     def tree(self, ref):
         """Returns a Tree instance for the given ref."""
         return Tree(self, ref)
 
-    @functools.lru_cache
-    def blob(self, path, ref):
-        """Returns a Blob instance for the given path."""
-        cmd = self.cmd("cat-file")
-        cmd.raw(True)
-        cmd.batch = "%(objectsize)"
+    @functools.lru_cache(maxsize=1024)
+    def blob(self, path: bytes, ref: str):
+        """Returns a Blob instance for the given path.
 
+        The path must be given as bytes, as that's what git works with, and
+        it may not be valid utf8.
+        """
         # Format: <ref>:<path>
         # Construct it in binary since the path might not be utf8.
-        cmd.stdin(ref.encode("utf8") + b":" + path)
-
-        out = cmd.run()
-        head = out.readline()
-        if not head or head.strip().endswith(b"missing"):
+        content = self.cat(ref.encode("utf8") + b":" + path)
+        if content is None:
             return None
 
-        return Blob(out.read()[: int(head)])
+        return Blob(content)
 
-    @functools.cache
+    @_memoized
     def last_commit_timestamp(self):
-        """Return the timestamp of the last commit."""
-        refs = self._for_each_ref(
-            pattern="refs/heads/", sort="-committerdate", count=1
+        """Return the timestamp of the last commit.
+
+        This comes from the same for-each-ref call as the branches and tags,
+        so rendering a repository needs a single one of them.
+        """
+        return max(
+            (
+                cdate
+                for _, _, ref, cdate, _, _ in self._all_refs_cached()
+                if ref.startswith("refs/heads/")
+            ),
+            default=-1,
         )
-        for obj_id, _, _ in refs:
-            commit = self.commit(obj_id)
-            return commit.committer_epoch
-        return -1
+
+
+# Repo instances by (path, name), see get_repo().
+_REPO_CACHE: Dict[tuple, Repo] = {}
+
+
+def get_repo(path: str, name=None) -> Repo:
+    """Returns the Repo for the given path and name, reusing the instance
+    (and its caches and processes) if it was already created."""
+    key = (path, name)
+    r = _REPO_CACHE.get(key)
+    if r is None:
+        r = _REPO_CACHE[key] = Repo(path, name=name)
+    return r
+
+
+def _reset_after_fork():
+    """Resets the state that a forked child can't share with its parent.
+
+    The thread pool's threads and the long-lived git processes belong to the
+    parent, so the child starts afresh with its own. Only the repositories
+    created via get_repo() are known to us.
+    """
+    Repo._pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=Repo._pool._max_workers
+    )
+    for r in _REPO_CACHE.values():
+        r._catfile_local = threading.local()
+        r._catfile_procs = []
+        r._catfile_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# Identity in commit headers: "<name> <<email>> <epoch> <tz>".
+_AUTHOR_RE = re.compile(r"(.*?) ?<([^>]*)> (\d+) ([+-]\d{4})")
+
+
+def _parse_ident(ident: str):
+    """Parses a commit identity, returns (name, email, epoch, tz)."""
+    m = _AUTHOR_RE.match(ident)
+    if m:
+        return m.groups()
+
+    # Malformed identity, we do our best.
+    ident, epoch, tz = ident.rsplit(" ", 2)
+    name, email_addr = email.utils.parseaddr(ident)
+    return name, email_addr, epoch, tz
 
 
 class Commit(object):
     """A git commit."""
 
+    # There can be a lot of these at once, so avoid a __dict__ per instance.
+    __slots__ = (
+        "_repo",
+        "id",
+        "parents",
+        "tree",
+        "author_name",
+        "author_email",
+        "author_epoch",
+        "author_tz",
+        "committer_name",
+        "committer_email",
+        "committer_epoch",
+        "committer_tz",
+        "message",
+        "_author_date",
+        "_committer_date",
+        "_diff",
+    )
+
     def __init__(
         self,
         repo,
         commit_id,
         parents,
         tree,
-        author,
+        author_name,
+        author_email,
         author_epoch,
         author_tz,
-        committer,
+        committer_name,
+        committer_email,
         committer_epoch,
         committer_tz,
         message,
@@ -381,26 +908,19 @@ class Commit(object):
         self.id = commit_id
         self.parents = parents
         self.tree = tree
-        self.author = author
+        self.author_name = author_name
+        self.author_email = author_email
         self.author_epoch = author_epoch
         self.author_tz = author_tz
-        self.committer = committer
+        self.committer_name = committer_name
+        self.committer_email = committer_email
         self.committer_epoch = committer_epoch
         self.committer_tz = committer_tz
         self.message = message
 
-        self.author_name, self.author_email = email.utils.parseaddr(
-            self.author
-        )
-
-        self.committer_name, self.committer_email = email.utils.parseaddr(
-            self.committer
-        )
-
-        self.subject, self.body = self.message.split("\n", 1)
-
-        self.author_date = Date(self.author_epoch, self.author_tz)
-        self.committer_date = Date(self.committer_epoch, self.committer_tz)
+        # Dates are only built when needed, many listings don't show them.
+        self._author_date: Optional["Date"] = None
+        self._committer_date: Optional["Date"] = None
 
         # Only get this lazily when we need it; most of the time it's not
         # required by the caller.
@@ -414,6 +934,40 @@ class Commit(object):
             self.subject[:20],
         )
 
+    # The subject and body are sliced out of the message when needed; most
+    # listings only want the subject, and messages can be long.
+    @property
+    def subject(self) -> str:
+        return self.message[: self.message.index("\n")]
+
+    @property
+    def body(self) -> str:
+        return self.message[self.message.index("\n") + 1 :]
+
+    @property
+    def author_date(self) -> "Date":
+        if self._author_date is None:
+            self._author_date = _make_date(
+                int(self.author_epoch), self.author_tz
+            )
+        return self._author_date
+
+    @property
+    def committer_date(self) -> "Date":
+        if self._committer_date is None:
+            self._committer_date = _make_date(
+                int(self.committer_epoch), self.committer_tz
+            )
+        return self._committer_date
+
+    @property
+    def author(self):
+        return "%s <%s>" % (self.author_name, self.author_email)
+
+    @property
+    def committer(self):
+        return "%s <%s>" % (self.committer_name, self.committer_email)
+
     @property
     def diff(self):
         """Return the diff for this commit, in unified format."""
@@ -431,164 +985,304 @@ class Commit(object):
             # Header only, no commit message
             header, raw_message = buf.rstrip(), "    "
 
-        header_lines = header.split("\n")
-        commit_id = header_lines.pop(0)
-
-        header_dict = defaultdict(list)
-        for line in header_lines:
-            k, v = line.split(" ", 1)
-            header_dict[k].append(v)
-
-        tree = header_dict["tree"][0]
-        parents = set(header_dict["parent"])
-
-        authorhdr = header_dict["author"][0]
-        author, author_epoch, author_tz = authorhdr.rsplit(" ", 2)
-
-        committerhdr = header_dict["committer"][0]
-        committer, committer_epoch, committer_tz = committerhdr.rsplit(" ", 2)
-
-        # Remove the first four spaces from the message's lines.
-        message = ""
-        for line in raw_message.split("\n"):
-            message += line[4:] + "\n"
+        commit_id = header[: header.index("\n")]
+
+        # The fields we care about come first, in this order; anything after
+        # the committer (e.g. signatures) is of no interest.
+        tree = None
+        parents = []
+        author = committer = None
+        for line in header.split("\n")[1:]:
+            if line.startswith("parent "):
+                parents.append(line[7:])
+            elif line.startswith("tree "):
+                tree = line[5:]
+            elif line.startswith("author "):
+                author = _parse_ident(line[7:])
+            elif line.startswith("committer "):
+                committer = _parse_ident(line[10:])
+                break
+
+        author_name, author_email, author_epoch, author_tz = author
+        (
+            committer_name,
+            committer_email,
+            committer_epoch,
+            committer_tz,
+        ) = committer
+
+        # Remove the first four spaces from the message's lines; git indents
+        # all of them (including empty ones), so we don't need to check.
+        message = raw_message[4:].replace("\n    ", "\n") + "\n"
 
         return Commit(
             repo,
             commit_id=commit_id,
             tree=tree,
             parents=parents,
-            author=author,
+            author_name=author_name,
+            author_email=author_email,
             author_epoch=author_epoch,
             author_tz=author_tz,
-            committer=committer,
+            committer_name=committer_name,
+            committer_email=committer_email,
             committer_epoch=committer_epoch,
             committer_tz=committer_tz,
             message=message,
         )
 
 
+# Timezone offsets as given by git, e.g. "+0100".
+_TZ_RE = re.compile(r"([+-])(\d\d)(\d\d)")
+
+
+@functools.lru_cache(maxsize=256)
+def _tz_offset(tz: str):
+    """Returns the offset of the given git timezone, as (minutes, timedelta).
+
+    There are only a few distinct timezones in a repository, so this is
+    cached to avoid parsing them for every date.
+    """
+    minutes = 0
+    m = _TZ_RE.fullmatch(tz)
+    if m:
+        sign, hh, mm = m.groups()
+        minutes = int(hh) * 60 + int(mm)
+        if sign == "-":
+            minutes = -minutes
+
+    return minutes, datetime.timedelta(minutes=minutes)
+
+
 class Date:
     """Handy representation for a datetime from git."""
 
+    __slots__ = ("epoch", "tz", "tz_sec_offset_min", "_utc", "_local", "_str")
+
     def __init__(self, epoch, tz):
         self.epoch = int(epoch)
         self.tz = tz
-        self.utc = datetime.datetime.utcfromtimestamp(self.epoch)
+        self.tz_sec_offset_min = _tz_offset(tz)[0]
 
-        self.tz_sec_offset_min = int(tz[1:3]) * 60 + int(tz[4:])
-        if tz[0] == "-":
-            self.tz_sec_offset_min = -self.tz_sec_offset_min
+        # The datetimes and the string are only built if they're used, as
+        # most dates are never rendered.
+        self._utc: Optional[datetime.datetime] = None
+        self._local: Optional[datetime.datetime] = None
+        self._str: Optional[str] = None
 
-        self.local = self.utc + datetime.timedelta(
-            minutes=self.tz_sec_offset_min
-        )
+    @property
+    def utc(self) -> datetime.datetime:
+        # Note we keep these as naive datetimes, as callers use them to
+        # display the date and time.
+        if self._utc is None:
+            self._utc = datetime.datetime.fromtimestamp(
+                self.epoch, tz=datetime.timezone.utc
+            ).replace(tzinfo=None)
+        return self._utc
+
+    @property
+    def local(self) -> datetime.datetime:
+        if self._local is None:
+            self._local = self.utc + _tz_offset(self.tz)[1]
+        return self._local
 
-        self.str = self.utc.strftime("%a, %d %b %Y %H:%M:%S +0000 ")
-        self.str += "(%s %s)" % (self.local.strftime("%H:%M"), self.tz)
+    @property
+    def str(self):
+        if self._str is None:
+            s = self.utc.strftime("%a, %d %b %Y %H:%M:%S +0000 ")
+            s += "(%s %s)" % (self.local.strftime("%H:%M"), self.tz)
+            self._str = s
+        return self._str
 
     def __str__(self):
         return self.str
 
 
+@functools.lru_cache(maxsize=4096)
+def _make_date(epoch: int, tz: str) -> Date:
+    """Returns a Date for the given epoch and timezone.
+
+    Dates are never modified after construction, so they can be shared:
+    commits made close together, or the same commit shown in different
+    places, will reuse the same instance (and its formatted string).
+    """
+    return Date(epoch, tz)
+
+
+# A line of git diff --numstat output: "<added>\t<deleted>\t<fname>", where
+# the counts are "-" for binary files.
+_NUMSTAT_RE = re.compile(r"^(\d+|-)\t(\d+|-)\t(.*)$", re.M)
+
+
 class Diff:
     """A diff between two trees."""
 
-    def __init__(self, ref, changes, body):
+    __slots__ = ("ref", "changes", "_body")
+
+    def __init__(self, ref, changes, body: Union[str, bytes]):
         """Constructor.
 
         - ref: reference id the diff refers to.
         - changes: [ (added, deleted, filename), ... ]
-        - body: diff body, as text, verbatim.
+        - body: diff body, verbatim; either as text, or as the raw bytes
+          from git, which are only decoded if the body is used.
         """
         self.ref = ref
         self.changes = changes
-        self.body = body
+        self._body = body
+
+    @property
+    def body(self) -> str:
+        """Diff body, as text."""
+        if isinstance(self._body, bytes):
+            self._body = _decode_text(self._body)
+        return self._body
 
     @staticmethod
-    def from_str(buf):
-        """Parses git diff-tree output, returns a Diff object."""
-        lines = iter(buf)
-        try:
-            ref_id = next(lines)
-        except StopIteration:
-            # No diff; this can happen in merges without conflicts.
-            return Diff(None, [], "")
+    def from_parts(ref_id: str, rest: bytes):
+        """Parses git diff-tree output, already split in the ref id line and
+        the rest, returns a Diff object.
 
-        # First, --numstat information.
-        changes = []
-        l = next(lines)
-        while l != "\n":
-            l = l.rstrip("\n")
-            added, deleted, fname = l.split("\t", 2)
-            added = added.replace("-", "0")
-            deleted = deleted.replace("-", "0")
-            fname = smstr(unquote(fname))
-            changes.append((int(added), int(deleted), fname))
-            l = next(lines)
+        The rest is the --numstat information, a blank line, and then the diff
+        body. We parse the numstat section with a single regex scan, and
+        slice the body out as-is; it's kept as bytes until it's needed.
+        """
+        end = rest.find(b"\n\n")
+        if end == -1:
+            end = len(rest)
+        numstat = _decode_text(rest[:end])
+
+        changes = [
+            (
+                int(added) if added != "-" else 0,
+                int(deleted) if deleted != "-" else 0,
+                _path_smstr(fname),
+            )
+            for added, deleted, fname in _NUMSTAT_RE.findall(numstat)
+        ]
 
         # And now the diff body. We just store as-is, we don't really care for
         # the contents.
-        body = "".join(lines)
+        body = rest[end + 2 :]
 
         return Diff(ref_id, changes, body)
 
 
+class TreeEntries(NamedTuple):
+    """Entries of a tree, as parallel lists of types, names and sizes.
+
+    Names are plain strings, as smstr instances are only needed for the
+    entries that are rendered; use smname() for those.
+    """
+
+    otypes: List[str]
+    names: List[str]
+    sizes: List[Optional[int]]
+
+    def smname(self, i: int) -> smstr:
+        """Returns the name of the i-th entry, as an smstr."""
+        return smstr(self.names[i])
+
+
 class Tree:
     """A git tree."""
 
+    __slots__ = ("repo", "ref", "_by_dir")
+
     def __init__(self, repo: Repo, ref: str):
         self.repo = repo
         self.ref = ref
 
-    @functools.lru_cache
-    def ls(
-        self, path, recursive=False
-    ) -> Iterable[Tuple[str, smstr, Optional[int]]]:
-        """Generates (type, name, size) for each file in path."""
-        cmd = self.repo.cmd("ls-tree")
-        cmd.long = None
+        # Entries of every directory, keyed by their path; see ls_all().
+        self._by_dir: Optional[Dict[str, TreeEntries]] = None
+
+    def ls_all(self) -> TreeEntries:
+        """Returns the entries of the whole tree, like ls("", recursive=True).
+
+        It also groups them by directory, so that further calls to ls() for
+        any directory are answered from memory instead of running git again.
+        """
+        entries = self.ls("", recursive=True)
+
+        by_dir: Dict[str, TreeEntries] = {}
+        for otype, name, size in zip(*entries):
+            dirname, _, basename = name.rpartition("/")
+            if dirname:
+                dirname += "/"
+            d = by_dir.get(dirname)
+            if d is None:
+                d = by_dir[dirname] = TreeEntries([], [], [])
+            d.otypes.append(otype)
+            d.names.append(basename)
+            d.sizes.append(size)
+
+        self._by_dir = by_dir
+        return entries
+
+    @functools.lru_cache(maxsize=256)
+    def ls(self, path, recursive=False) -> TreeEntries:
+        """Returns the (types, names, sizes) of the files in path."""
+        if not recursive and self._by_dir is not None:
+            if path in self._by_dir:
+                return self._by_dir[path]
+            if not path or path.endswith("/"):
+                # Not a directory in this tree.
+                return TreeEntries([], [], [])
+
+        # With -z, names are not quoted, so we don't need to unquote them.
+        params = ["ls-tree", "--long", "-z"]
         if recursive:
-            cmd.r = None
-            cmd.t = None
+            params += ["-r", "-t"]
 
-        cmd.arg(self.ref)
+        params.append(self.ref)
         if not path:
-            cmd.arg(".")
+            params.append(".")
         else:
-            cmd.arg(path)
-
-        files = []
-        for l in cmd.run():
-            _mode, otype, _oid, size, name = l.split(None, 4)
-            if size == "-":
-                size = None
-            else:
-                size = int(size)
-
-            # Remove the quoting (if any); will always give us a str.
-            name = unquote(name.strip("\n"))
+            params.append(path)
+
+        otypes: List[str] = []
+        names: List[str] = []
+        sizes: List[Optional[int]] = []
+        out = run_git(self.repo.path, params, raw=True, read_all=True).read()
+
+        # Each entry is "<mode> <type> <id> <size>\t<name>\0". We decode it
+        # all at once, which is fine as the separators are ASCII; invalid
+        # sequences are escaped just like unquote() does.
+        for entry in out.decode("utf8", "backslashreplace").split("\0"):
+            if not entry:
+                continue
+            info, name = entry.split("\t", 1)
+            _mode, otype, _oid, size_str = info.split()
+            size = None if size_str == "-" else int(size_str)
 
             # Strip the leading path, the caller knows it and it's often
             # easier to work with this way.
             name = name[len(path) :]
 
-            # We use a smart string for the name, as it's often tricky to
-            # manipulate otherwise.
-            files.append((otype, smstr(name), size))
+            otypes.append(otype)
+            names.append(name)
+            sizes.append(size)
 
-        return files
+        return TreeEntries(otypes, names, sizes)
 
 
 class Blob:
     """A git blob."""
 
+    __slots__ = ("raw_content", "_utf8_content")
+
     def __init__(self, raw_content: bytes):
         self.raw_content = raw_content
-        self._utf8_content = None
+        self._utf8_content: Optional[str] = None
+
+    @property
+    def is_binary(self) -> bool:
+        """True if the blob looks binary, using the same heuristic as git (a
+        NUL in the first 8KB). It doesn't need to decode the content."""
+        return self.raw_content.find(b"\0", 0, 8192) != -1
 
     @property
     def utf8_content(self):
-        if not self._utf8_content:
+        if self._utf8_content is None:
             self._utf8_content = self.raw_content.decode("utf8", "replace")
         return self._utf8_content
@@ -10,6 +10,8 @@ try:
     from pygments import lexers  # type: ignore
     from pygments.formatters import HtmlFormatter  # type: ignore
 
+    _diff_lexer = lexers.DiffLexer(encoding="utf-8")
+    _diff_formatter = HtmlFormatter(encoding="utf-8", cssclass="source_code")
     _html_formatter = HtmlFormatter(
         encoding="utf-8",
         cssclass="source_code",
@@ -20,30 +22,92 @@ try:
 except ImportError:
     pygments = None
 
+try:
+    # Preferred for rendering markdown, as it's much faster than markdown.
+    from markdown_it import MarkdownIt  # type: ignore
+except ImportError:
+    MarkdownIt = None
+
 try:
     import markdown  # type: ignore
-    import markdown.treeprocessors  # type: ignore
 except ImportError:
     markdown = None
 
-import base64
+try:
+    # Vectorized base64, much faster for big images.
+    import pybase64 as base64  # type: ignore
+except ImportError:
+    import base64
+
+import collections
+import fnmatch
 import functools
+import hashlib
 import mimetypes
 import string
 import os.path
+import re
+import threading
+import urllib.parse
+from typing import AnyStr, Dict, Union
 
 import git
 
 
 def shorten(s: str, width=60):
-    if len(s) < 60:
+    if len(s) < width:
         return s
-    return s[:57] + "..."
+    return s[: width - 3] + "..."
+
+
+def _digest(s: Union[str, bytes]) -> bytes:
+    """Short digest of the given content, to use as a cache key.
 
+    64 bits are plenty to tell apart the few hundred entries our caches
+    hold, and hashing is done only once per lookup.
+    """
+    if isinstance(s, str):
+        s = s.encode("utf8", "surrogateescape")
+    return hashlib.blake2b(s, digest_size=8).digest()
+
+
+def _content_cache(maxsize=128):
+    """Like functools.lru_cache(), but keyed on a digest of the function's
+    last argument, which is the (potentially big) content to process.
+
+    That way the cache doesn't keep all the contents it has seen alive;
+    only the results, which are bounded by maxsize.
+    """
+
+    def decorator(f):
+        cache: collections.OrderedDict = collections.OrderedDict()
+
+        @functools.wraps(f)
+        def wrapper(*args):
+            key = args[:-1] + (_digest(args[-1]),)
+            try:
+                r = cache[key]
+                cache.move_to_end(key)
+                return r
+            except KeyError:
+                pass
 
-@functools.lru_cache
-def can_colorize(s: str):
-    """True if we can colorize the string, False otherwise."""
+            r = cache[key] = f(*args)
+            while len(cache) > maxsize:
+                cache.popitem(last=False)
+            return r
+
+        return wrapper
+
+    return decorator
+
+
+def can_colorize(s: Union[str, bytes]):
+    """True if we can colorize the string, False otherwise.
+
+    It can also be given the raw bytes, which saves decoding content that
+    we're not going to colorize; limits are then measured in bytes.
+    """
     if pygments is None:
         return False
 
@@ -53,22 +117,29 @@ def can_colorize(s: str):
         return False
 
     # If any of the first 5 lines is over 300 characters long, don't colorize.
+    if isinstance(s, bytes):
+        return not _has_long_first_lines(s, b"\n")
+    return not _has_long_first_lines(s, "\n")
+
+
+def _has_long_first_lines(s: AnyStr, nl: AnyStr) -> bool:
+    """True if any of the first 5 lines is over 300 characters long."""
     start = 0
     for i in range(5):
-        pos = s.find("\n", start)
+        pos = s.find(nl, start)
         if pos == -1:
             break
 
         if pos - start > 300:
-            return False
+            return True
         start = pos + 1
 
-    return True
+    return False
 
 
 def can_markdown(repo: git.Repo, fname: str):
     """True if we can process file through markdown, False otherwise."""
-    if markdown is None:
+    if MarkdownIt is None and markdown is None:
         return False
 
     if not repo.info.embed_markdown:
@@ -77,29 +148,91 @@ def can_markdown(repo: git.Repo, fname: str):
     return fname.endswith(".md")
 
 
+# Extensions of the image files we embed, and their mime types; see
+# can_embed_image() and embed_image_blob().
+_IMAGE_MIMETYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+}
+_IMAGE_SUFFIXES = tuple(_IMAGE_MIMETYPES)
+
+
 def can_embed_image(repo, fname):
     """True if we can embed image file in HTML, False otherwise."""
     if not repo.info.embed_images:
         return False
 
-    return ("." in fname) and (
-        fname.split(".")[-1].lower() in ["jpg", "jpeg", "png", "gif"]
-    )
+    # Only the tail can match, so just lowercase that.
+    return fname[-5:].lower().endswith(_IMAGE_SUFFIXES)
 
 
-@functools.lru_cache
+@_content_cache()
 def colorize_diff(s: str) -> str:
-    lexer = lexers.DiffLexer(encoding="utf-8")
-    formatter = HtmlFormatter(encoding="utf-8", cssclass="source_code")
-
-    return highlight(s, lexer, formatter)
-
-
-@functools.lru_cache
-def colorize_blob(fname, s: str) -> str:
-    try:
+    return highlight(s, _diff_lexer, _diff_formatter)
+
+
+# A filename pattern that just matches an extension, like "*.py".
+_SUFFIX_PATTERN_RE = re.compile(r"\*(\.[^*?\[\]]+)")
+
+
+@functools.cache
+def _lexer_filename_patterns():
+    """Returns the filename patterns of all of pygments' lexers, as
+    ({suffix: [lexer class, ...]}, [(other pattern, lexer class), ...]).
+
+    Almost all patterns just match an extension, so they can be looked up
+    in a dict instead of matched one by one. This loads every lexer, so we
+    only want to do it once.
+    """
+    by_suffix: Dict[str, list] = {}
+    others = []
+    for name, _, _, _ in lexers.get_all_lexers():
+        cls = lexers.find_lexer_class(name)
+        for pattern in cls.filenames + cls.alias_filenames:
+            m = _SUFFIX_PATTERN_RE.fullmatch(pattern)
+            if m:
+                by_suffix.setdefault(m.group(1), []).append(cls)
+            else:
+                others.append((pattern, cls))
+    return by_suffix, others
+
+
+@functools.lru_cache(maxsize=512)
+def _lexers_for_filename(fname: str):
+    """Lexer classes with a filename pattern that matches fname.
+
+    This is the same set guess_lexer_for_filename() considers, but cached
+    per file name so we don't walk all of pygments' lexers every time.
+    """
+    fname = os.path.basename(fname)
+    by_suffix, others = _lexer_filename_patterns()
+
+    # Check every suffix starting at a ".", so "a.tar.gz" matches both
+    # "*.gz" and "*.tar.gz".
+    found = []
+    pos = fname.find(".")
+    while pos != -1:
+        for cls in by_suffix.get(fname[pos:], ()):
+            if cls not in found:
+                found.append(cls)
+        pos = fname.find(".", pos + 1)
+
+    for pattern, cls in others:
+        if cls not in found and fnmatch.fnmatchcase(fname, pattern):
+            found.append(cls)
+    return tuple(found)
+
+
+def _blob_lexer(fname, s: str):
+    candidates = _lexers_for_filename(fname)
+    if len(candidates) == 1:
+        # Nothing to choose from, so no need to look at the content.
+        lexer = candidates[0](encoding="utf-8")
+    elif candidates:
         lexer = lexers.guess_lexer_for_filename(fname, s, encoding="utf-8")
-    except lexers.ClassNotFound:
+    else:
         # Only try to guess lexers if the file starts with a shebang,
         # otherwise it's likely a text file and guess_lexer() is prone to
         # make mistakes with those.
@@ -110,87 +243,177 @@ def colorize_blob(fname, s: str) -> str:
             except lexers.ClassNotFound:
                 pass
 
-    return highlight(s, lexer, _html_formatter)
+    return lexer
 
 
-def embed_image_blob(fname: str, image_data: bytes) -> str:
-    mimetype = mimetypes.guess_type(fname)[0]
-    b64img = base64.b64encode(image_data).decode("ascii")
-    return '<img style="max-width:100%;" src="data:{0};base64,{1}" />'.format(
-        mimetype, b64img
+@_content_cache()
+def colorize_blob(fname, s: str) -> str:
+    return highlight(s, _blob_lexer(fname, s), _html_formatter)
+
+
+class _Appender:
+    """File-like object that appends everything written to a list."""
+
+    __slots__ = ("write",)
+
+    def __init__(self, out: list):
+        self.write = out.append
+
+
+def colorize_blob_to(fname, s: str, out: list):
+    """Like colorize_blob(), but appends the HTML to out as it's generated.
+
+    This is meant to be given the template's output list (_stdout), so the
+    colorized blob is never built as a whole separate string.
+    """
+    tokens = _blob_lexer(fname, s).get_tokens(s)
+    _html_formatter.format_unencoded(tokens, _Appender(out))
+
+
+# The <img> tag for embedded images goes around the base64 data; the start of
+# it depends only on the mime type, so it's built once per type.
+_IMG_END = b'" />'
+
+
+@functools.lru_cache(maxsize=32)
+def _img_start(mimetype: str) -> bytes:
+    return (
+        b'<img style="max-width:100%;" src="data:'
+        + mimetype.encode("ascii")
+        + b";base64,"
     )
 
 
-@functools.lru_cache
-def is_binary(b: bytes):
+def _image_mimetype(fname: str) -> str:
+    ext = fname[fname.rfind(".") :].lower()
+    return str(_IMAGE_MIMETYPES.get(ext) or mimetypes.guess_type(fname)[0])
+
+
+def embed_image_blob(fname: str, image_data: bytes) -> str:
+    mimetype = _image_mimetype(fname)
+
+    # Build it as bytes and decode once at the end, so the (potentially big)
+    # base64 payload is not copied into intermediate strings.
+    return b"".join(
+        (_img_start(mimetype), base64.b64encode(image_data), _IMG_END)
+    ).decode("ascii")
+
+
+# Size of the image chunks embed_image_blob_to() encodes at a time. It must
+# be a multiple of 3, so there's no base64 padding in between chunks.
+_EMBED_CHUNK_SIZE = 57 * 1024
+
+
+def embed_image_blob_to(fname: str, image_data: bytes, out: list):
+    """Like embed_image_blob(), but appends the HTML to out in chunks.
+
+    This is meant to be given the template's output list (_stdout), so the
+    base64 representation of big images is never held in full on top of
+    the page being built.
+    """
+    out.append(_img_start(_image_mimetype(fname)).decode("ascii"))
+    mv = memoryview(image_data)
+    for i in range(0, len(mv), _EMBED_CHUNK_SIZE):
+        chunk = mv[i : i + _EMBED_CHUNK_SIZE]
+        out.append(base64.b64encode(chunk).decode("ascii"))
+    out.append(_IMG_END.decode("ascii"))
+
+
+def is_binary(b: bytes) -> bool:
     # Git considers a blob binary if NUL in first ~8KB, so do the same.
-    return b"\0" in b[:8192]
+    # Bound the search instead of slicing, to avoid copying those 8KB.
+    return b.find(b"\0", 0, 8192) != -1
+
+
+# Translation table for the text column of hexdump(): printable characters
+# are kept as-is, and everything else is shown as ".".
+_HEXDUMP_GRAPH = (
+    string.ascii_letters + string.digits + string.punctuation + " "
+)
+_HEXDUMP_TABLE = bytes(
+    c if chr(c) in _HEXDUMP_GRAPH else ord(".") for c in range(256)
+)
 
 
-@functools.lru_cache
 def hexdump(s: bytes):
-    graph = string.ascii_letters + string.digits + string.punctuation + " "
-    b = s.decode("latin1")
-    offset = 0
-    while b:
-        t = b[:16]
-        hexvals = ["%.2x" % ord(c) for c in t]
-        text = "".join(c if c in graph else "." for c in t)
-        yield offset, " ".join(hexvals[:8]), " ".join(hexvals[8:]), text
-        offset += 16
-        b = b[16:]
-
-
-if markdown:
-
-    class RewriteLocalLinks(markdown.treeprocessors.Treeprocessor):
-        """Rewrites relative links to files, to match git-arr's links.
-
-        A link of "[example](a/file.md)" will be rewritten such that it links to
-        "a/f=file.md.html".
-
-        Note that we're already assuming a degree of sanity in the HTML, so we
-        don't re-check that the path is reasonable.
-        """
-
-        def run(self, root):
-            for child in root:
-                if child.tag == "a":
-                    self.rewrite_href(child)
-
-                # Continue recursively.
-                self.run(child)
-
-        def rewrite_href(self, tag):
-            """Rewrite an <a>'s href."""
-            target = tag.get("href")
-            if not target:
-                return
-            if "://" in target or target.startswith("/"):
-                return
-
-            head, tail = os.path.split(target)
-            new_target = os.path.join(head, "f=" + tail + ".html")
-            tag.set("href", new_target)
-
-    class RewriteLocalLinksExtension(markdown.Extension):
-        def extendMarkdown(self, md):
-            md.treeprocessors.register(
-                RewriteLocalLinks(), "RewriteLocalLinks", 1000
-            )
+    """Yields (offset, hex1, hex2, text) for each 16 byte row of s.
+
+    Rows are sliced by offset from the original buffer, so this is linear
+    in the size of s, and can be consumed as it goes.
+    """
+    for offset in range(0, len(s), 16):
+        t = s[offset : offset + 16]
+        # Each byte is "xx ", so the first 8 bytes take the first 23 chars.
+        h = t.hex(" ")
+        hex1 = h[:23]
+        hex2 = h[24:]
+        text = t.translate(_HEXDUMP_TABLE).decode("ascii")
+        yield offset, hex1, hex2, text
+
+
+# An <a> tag's href in the HTML we generate from markdown, see
+# rewrite_local_links().
+_HREF_RE = re.compile(r'(<a\s[^>]*?\bhref=")([^"]*)(")')
+
+
+def _rewrite_href(m: re.Match) -> str:
+    target = urllib.parse.urlsplit(m.group(2))
+    if target.scheme or target.netloc:
+        # Not a local link, like "https://..." or "mailto:...".
+        return m.group(0)
+    if not target.path or target.path.startswith("/"):
+        # Empty (e.g. "#section"), or absolute.
+        return m.group(0)
+
+    # Only the path is rewritten; the query and fragment are kept as-is.
+    head, tail = os.path.split(target.path)
+    path = os.path.join(head, "f=" + tail + ".html")
+    href = urllib.parse.urlunsplit(target._replace(path=path))
+    return m.group(1) + href + m.group(3)
+
+
+def rewrite_local_links(html: str) -> str:
+    """Rewrites relative links to files, to match git-arr's links.
+
+    A link of "[example](a/file.md)" will be rewritten such that it links to
+    "a/f=file.md.html", keeping any query or fragment after the new name.
+    This is done with a single regex pass over the rendered HTML, which is
+    much cheaper than walking the document tree.
+
+    Note that we're already assuming a degree of sanity in the HTML, so we
+    don't re-check that the path is reasonable.
+    """
+    return _HREF_RE.sub(_rewrite_href, html)
+
+
+if MarkdownIt:
+    # CommonMark already includes fenced code blocks; tables are the only
+    # extension we need to match what we use with markdown.
+    _mdit = MarkdownIt("commonmark", {"html": True}).enable("table")
+
+    @_content_cache()
+    def markdown_blob(s: str) -> str:
+        return rewrite_local_links(_mdit.render(s))
 
+elif markdown:
     _md_extensions = [
         "markdown.extensions.fenced_code",
         "markdown.extensions.tables",
-        RewriteLocalLinksExtension(),
     ]
 
-    @functools.lru_cache
+    # Setting up a Markdown instance (loading the extensions, building all
+    # the processors) is expensive, so we use a single one. It keeps state
+    # while converting, hence the lock.
+    _md = markdown.Markdown(extensions=_md_extensions)
+    _md_lock = threading.Lock()
+
+    @_content_cache()
     def markdown_blob(s: str) -> str:
-        return markdown.markdown(s, extensions=_md_extensions)
+        with _md_lock:
+            html = _md.reset().convert(s)
+        return rewrite_local_links(html)
 
 else:
 
-    @functools.lru_cache
     def markdown_blob(s: str) -> str:
         raise RuntimeError("markdown_blob() called without markdown support")